@@ -7,25 +7,86 @@ This application provides a simple web interface to sync data between:
 
 Security considerations:
 - Service account credentials should be stored securely
-- MSAL tokens are handled securely in memory
+- MSAL tokens are cached in memory and in an owner-only cache file
 - No sensitive data is logged or exposed in error messages
 """
 
+import gzip
+import io
 import os
+import re
 import json
+import logging
 import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote
 from flask import Flask, render_template, request, jsonify, session
 import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import column_index_from_string, get_column_letter
 
 # Google Sheets imports
 from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.http import DEFAULT_HTTP_TIMEOUT_SEC
+import google_auth_httplib2
+import httplib2
 
 # Microsoft Graph imports
 import msal
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def _log_level(name):
+    """Return the logging level for a LOG_LEVEL value, falling back to WARNING"""
+    name = name.strip().upper()
+    level = int(name) if name.isdigit() else logging.getLevelName(name)
+    return level if isinstance(level, int) else logging.WARNING
+
+# Configure only this module's logger so importing the app leaves the host's logging alone
+log = logging.getLogger(__name__)
+log.setLevel(_log_level(os.environ.get('LOG_LEVEL', 'WARNING')))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log.addHandler(_log_handler)
+
+def _a1_range_limits(a1_range):
+    """Return how many (rows, columns) an A1 range spans, with None where it's unbounded.
+    Returns None altogether when the range's extent can't be known from its text"""
+    _, bang, ref = a1_range.rpartition('!')
+    if not bang:
+        # The API reads a bare "Jan" or "Q1" as a sheet if one has that name and as a cell
+        # otherwise, so only a quoted name is known to cover the whole sheet
+        return (None, None) if a1_range.startswith("'") else None
+    
+    start, _, end = ref.replace('$', '').partition(':')
+    bounds = [re.fullmatch(r'([A-Za-z]{0,3})(\d*)', part) for part in (start, end or start)]
+    if not all(bounds):
+        # A bare sheet name covers the whole sheet
+        return None, None
+    
+    (start_col, start_row), (end_col, end_row) = (b.groups() for b in bounds)
+    rows = int(end_row) - int(start_row) + 1 if start_row and end_row else None
+    cols = (column_index_from_string(end_col) - column_index_from_string(start_col) + 1
+            if start_col and end_col else None)
+    return rows, cols
+
+def _json_cell(value):
+    """Return an object-column cell as something JSON can carry, with '' for missing"""
+    if isinstance(value, float) and value != value:
+        return ''
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if value is None or value is pd.NA or value is pd.NaT:
+        return ''
+    # Timestamps, dates, Decimals and the like go over as their text
+    return str(value)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key-change-in-production')
@@ -33,6 +94,7 @@ app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key-change-in-p
 # Configuration - These should be set as environment variables in production
 GOOGLE_SHEETS_ID = os.environ.get('GOOGLE_SHEETS_ID', 'your-google-sheets-id')
 GOOGLE_SHEET_RANGE = os.environ.get('GOOGLE_SHEET_RANGE', 'Sheet1!A:Z')
+GOOGLE_RANGE_LIMITS = _a1_range_limits(GOOGLE_SHEET_RANGE)
 ONEDRIVE_FILE_ID = os.environ.get('ONEDRIVE_FILE_ID', 'your-onedrive-file-id')
 EXCEL_WORKSHEET_NAME = os.environ.get('EXCEL_WORKSHEET_NAME', 'Sheet1')
 
@@ -42,13 +104,73 @@ TENANT_ID = os.environ.get('AZURE_TENANT_ID', 'your-tenant-id')
 CLIENT_SECRET = os.environ.get('AZURE_CLIENT_SECRET', 'your-client-secret')
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPES = ["https://graph.microsoft.com/Files.ReadWrite"]
+# Google API request bodies larger than this are sent gzip-compressed
+GZIP_MIN_BYTES = 4096
+# (connect, read) seconds for Graph calls, so a stalled request can't hold the sync lock forever
+GRAPH_TIMEOUT = (10, 60)
+MSAL_CACHE_PATH = os.environ.get('MSAL_CACHE_PATH', 'msal_cache.bin')
+GRAPH_ITEM_URL = f"https://graph.microsoft.com/v1.0/me/drive/items/{ONEDRIVE_FILE_ID}"
+GRAPH_CONTENT_URL = f"{GRAPH_ITEM_URL}/content"
+# OData string literals double their quotes; the name is then URL-encoded for the path
+GRAPH_WORKSHEET_KEY = quote(EXCEL_WORKSHEET_NAME.replace("'", "''"), safe='')
+GRAPH_WORKSHEET_URL = f"{GRAPH_ITEM_URL}/workbook/worksheets('{GRAPH_WORKSHEET_KEY}')"
+GRAPH_VALUES_URL = f"{GRAPH_WORKSHEET_URL}/usedRange(valuesOnly=true)?$select=values"
+# Sheet limits of an .xlsx workbook
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_COLS = 16384
+# Keep each range PATCH well under Graph's request size limit
+GRAPH_MAX_CELLS_PER_PATCH = 10000
+# Graph error codes meaning the file can't be used through the workbook API
+GRAPH_UNSUPPORTED_CODES = {'notsupported', 'notimplemented'}
+GRAPH_JSON_HEADERS = {'Content-Type': 'application/json'}
+GRAPH_XLSX_HEADERS = {'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
+
+class GzipHttp(httplib2.Http):
+    """httplib2 transport that gzip-compresses large request bodies"""
+    
+    def __init__(self, timeout=DEFAULT_HTTP_TIMEOUT_SEC, **kwargs):
+        # Keep the defaults googleapiclient's build_http() would have given us
+        super().__init__(timeout=timeout, **kwargs)
+        # 308 is a resumable-upload status for Google APIs, not a redirect
+        self.redirect_codes = self.redirect_codes - {308}
+    
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        if isinstance(body, (str, bytes)) and len(body) > GZIP_MIN_BYTES:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            body = gzip.compress(body)
+            # googleapiclient already set content-length for the uncompressed body
+            headers = {k: v for k, v in (headers or {}).items() if k.lower() != 'content-length'}
+            headers['content-encoding'] = 'gzip'
+            headers['content-length'] = str(len(body))
+        return super().request(uri, method, body, headers, *args, **kwargs)
 
 class DataSyncManager:
     """Manages data synchronization between Google Sheets and OneDrive Excel"""
     
     def __init__(self):
         self.google_service = None
+        self.drive_service = None
         self.msal_app = None
+        self._token_cache = None
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
+        # Syncs share cached state and the non-thread-safe Google transports
+        self._sync_lock = threading.Lock()
+        self._last_etags = None
+        self._excel_cache = None
+        self._google_extent = None
+        # Both sync legs are network-bound, so run them side by side
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        # Share keep-alive connections to Graph across calls and retries
+        self._http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self._http.mount("https://", adapter)
         self._init_google_service()
         self._init_msal_app()
     
@@ -62,48 +184,126 @@ class DataSyncManager:
             
             credentials = service_account.Credentials.from_service_account_file(
                 credentials_path,
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
+                scopes=[
+                    'https://www.googleapis.com/auth/spreadsheets',
+                    'https://www.googleapis.com/auth/drive.metadata.readonly'
+                ]
             )
             
-            self.google_service = build('sheets', 'v4', credentials=credentials)
+            # Sheets writes can carry large JSON bodies, so compress them on the wire
+            authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=GzipHttp())
+            # Use the discovery documents bundled with the client library instead of fetching them
+            self.google_service = build('sheets', 'v4', http=authorized_http,
+                                        static_discovery=True, cache_discovery=False)
+            # Drive exposes the spreadsheet's modification metadata
+            self.drive_service = build('drive', 'v3', credentials=credentials,
+                                       static_discovery=True, cache_discovery=False)
         except Exception as e:
-            print(f"Error initializing Google Sheets service: {str(e)}")
+            log.warning("Error initializing Google Sheets service: %s", e)
             self.google_service = None
+            self.drive_service = None
     
     def _init_msal_app(self):
         """Initialize MSAL application for Microsoft Graph authentication"""
+        # Warm-start from the tokens a previous process left behind
+        self._token_cache = msal.SerializableTokenCache()
+        if os.path.exists(MSAL_CACHE_PATH):
+            try:
+                with open(MSAL_CACHE_PATH) as f:
+                    self._token_cache.deserialize(f.read())
+            except Exception as e:
+                # A corrupt or incompatible cache only costs one token request
+                log.warning("Ignoring unreadable MSAL token cache: %s", e)
+                self._token_cache = msal.SerializableTokenCache()
+        
         try:
             self.msal_app = msal.ConfidentialClientApplication(
                 CLIENT_ID,
                 authority=AUTHORITY,
-                client_credential=CLIENT_SECRET
+                client_credential=CLIENT_SECRET,
+                token_cache=self._token_cache,
+                timeout=GRAPH_TIMEOUT
             )
         except Exception as e:
-            print(f"Error initializing MSAL app: {str(e)}")
+            log.warning("Error initializing MSAL app: %s", e)
             self.msal_app = None
     
+    def _save_token_cache(self):
+        """Persist the MSAL token cache if it changed"""
+        if not self._token_cache or not self._token_cache.has_state_changed:
+            return
+        
+        try:
+            # Write a private temp file and swap it in so readers never see a partial cache
+            temp_path = f"{MSAL_CACHE_PATH}.{os.getpid()}.tmp"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self._token_cache.serialize())
+            os.replace(temp_path, MSAL_CACHE_PATH)
+        except OSError as e:
+            log.warning("Error saving MSAL token cache: %s", e)
+    
     def _get_access_token(self):
         """Get access token for Microsoft Graph API"""
         if not self.msal_app:
             return None
         
+        # Serve the in-process token until shortly before it expires
+        if self._token and time.monotonic() < self._token_expires - 60:
+            return self._token
+        
+        with self._token_lock:
+            # Another thread may have refreshed the token while we waited
+            if self._token and time.monotonic() < self._token_expires - 60:
+                return self._token
+            
+            try:
+                result = self.msal_app.acquire_token_for_client(scopes=SCOPES)
+                self._save_token_cache()
+                if "access_token" in result:
+                    self._token = result["access_token"]
+                    self._token_expires = time.monotonic() + int(result.get("expires_in", 3599))
+                    # Graph calls pick up the bearer header from the session
+                    self._http.headers['Authorization'] = f'Bearer {self._token}'
+                    return self._token
+                else:
+                    log.error("Error acquiring token: %s", result.get('error_description', 'Unknown error'))
+                    return None
+            except Exception as e:
+                log.exception("Error getting access token: %s", e)
+                return None
+    
+    def _google_etag(self):
+        """Get a cheap change token for the Google Sheets document"""
+        if not self.drive_service:
+            return None
+        
         try:
-            # Try to get token from cache first
-            accounts = self.msal_app.get_accounts()
-            if accounts:
-                result = self.msal_app.acquire_token_silent(SCOPES, account=accounts[0])
-                if result and "access_token" in result:
-                    return result["access_token"]
-            
-            # If no cached token, acquire new one using client credentials flow
-            result = self.msal_app.acquire_token_for_client(scopes=SCOPES)
-            if "access_token" in result:
-                return result["access_token"]
-            else:
-                print(f"Error acquiring token: {result.get('error_description', 'Unknown error')}")
+            result = self.drive_service.files().get(
+                fileId=GOOGLE_SHEETS_ID,
+                fields='modifiedTime,version'
+            ).execute()
+            return f"{result.get('version')}:{result.get('modifiedTime')}"
+        except Exception as e:
+            log.warning("Error reading Google Sheets metadata: %s", e)
+            return None
+    
+    def _onedrive_etag(self):
+        """Get a cheap change token for the OneDrive Excel file"""
+        if not self._get_access_token():
+            return None
+        
+        try:
+            response = self._http.get(f"{GRAPH_ITEM_URL}?$select=eTag,cTag", timeout=GRAPH_TIMEOUT)
+            
+            if response.status_code != 200:
                 return None
+            
+            # cTag only changes with the file content, eTag also with metadata
+            item = response.json()
+            return item.get('cTag') or item.get('eTag')
         except Exception as e:
-            print(f"Error getting access token: {str(e)}")
+            log.warning("Error reading OneDrive metadata: %s", e)
             return None
     
     def read_google_sheets_data(self):
@@ -118,12 +318,13 @@ class DataSyncManager:
             ).execute()
             
             values = result.get('values', [])
+            # Remember how much of the sheet is filled so a later write can cover it
+            self._google_extent = (len(values), max((len(row) for row in values), default=0))
             if not values:
                 return [], "No data found in Google Sheets"
             
-            # Convert to DataFrame for easier manipulation
-            df = pd.DataFrame(values[1:], columns=values[0] if values else [])
-            return df, None
+            # Rows are passed through as-is; pandas is only used where it's needed
+            return values, None
         except Exception as e:
             return None, f"Error reading Google Sheets: {str(e)}"
     
@@ -133,88 +334,216 @@ class DataSyncManager:
             return False, "Google Sheets service not initialized"
         
         try:
-            # Convert DataFrame to list of lists
-            if isinstance(data, pd.DataFrame):
-                values = [data.columns.tolist()] + data.values.tolist()
-            else:
-                values = data
+            values = self._to_cell_values(data)
+            width = len(values[0]) if values else 0
             
-            body = {'values': values}
+            # The extent is only trusted once, right after the read that recorded it. Rows
+            # another editor adds between that read and this write are not blanked
+            extent, self._google_extent = self._google_extent, None
             
-            # Clear existing data first
-            self.google_service.spreadsheets().values().clear(
-                spreadsheetId=GOOGLE_SHEETS_ID,
-                range=GOOGLE_SHEET_RANGE
-            ).execute()
+            if extent is None or GOOGLE_RANGE_LIMITS is None:
+                # Unknown previous extent or range size, so clear it in a separate call
+                self.google_service.spreadsheets().values().clear(
+                    spreadsheetId=GOOGLE_SHEETS_ID,
+                    range=GOOGLE_SHEET_RANGE
+                ).execute()
+            else:
+                # Pad with blanks up to the previous extent so one write also clears
+                # leftovers, but never past the configured range or the API rejects it
+                old_rows, old_cols = extent
+                max_rows, max_cols = GOOGLE_RANGE_LIMITS
+                if max_rows is not None:
+                    old_rows = min(old_rows, max_rows)
+                if max_cols is not None:
+                    old_cols = min(old_cols, max_cols)
+                width = max(width, old_cols)
+                values = [row + [''] * (width - len(row)) for row in values]
+                values += [[''] * width for _ in range(old_rows - len(values))]
             
-            # Write new data
-            result = self.google_service.spreadsheets().values().update(
+            body = {
+                'valueInputOption': 'RAW',
+                'data': [{'range': GOOGLE_SHEET_RANGE, 'values': values}]
+            }
+            result = self.google_service.spreadsheets().values().batchUpdate(
                 spreadsheetId=GOOGLE_SHEETS_ID,
-                range=GOOGLE_SHEET_RANGE,
-                valueInputOption='RAW',
                 body=body
             ).execute()
             
-            return True, f"Updated {result.get('updatedCells', 0)} cells"
+            return True, f"Updated {result.get('totalUpdatedCells', 0)} cells"
         except Exception as e:
             return False, f"Error writing to Google Sheets: {str(e)}"
     
-    def read_onedrive_excel_data(self):
-        """Read data from OneDrive Excel file"""
-        access_token = self._get_access_token()
-        if not access_token:
+    def _to_cell_values(self, data):
+        """Convert a DataFrame or list of rows to a rectangular list of lists"""
+        if isinstance(data, pd.DataFrame):
+            # Convert column by column so complete numeric and text columns skip the object cast
+            columns = []
+            for i in range(data.shape[1]):
+                col = data.iloc[:, i]
+                if col.dtype.kind in 'mM':
+                    # Timestamps aren't JSON serializable, so send them as text
+                    col = col.astype(str).where(col.notna(), '')
+                elif col.dtype.kind == 'O':
+                    # Object columns can hold any Python value, missing or not
+                    col = col.map(_json_cell)
+                elif col.dtype.kind not in 'biuf' or col.hasnans:
+                    col = col.astype(object).where(col.notna(), '')
+                columns.append(col.to_numpy().tolist())
+            
+            values = [[str(col) for col in data.columns]]
+            values.extend(map(list, zip(*columns)))
+            return values
+        
+        # Rows read from Google Sheets omit trailing empty cells
+        width = max((len(row) for row in data), default=0)
+        if all(isinstance(row, list) and len(row) == width for row in data):
+            # Already rectangular, so there is nothing to copy
+            return data
+        return [list(row) + [''] * (width - len(row)) for row in data]
+    
+    def _workbook_unsupported(self, response):
+        """Check whether Graph rejected a workbook call that the whole-file API can still handle"""
+        if response.status_code in (413, 501):
+            # Too large for one workbook call, or a file the workbook API can't edit
+            return True
+        if response.status_code != 400:
+            return False
+        
+        try:
+            code = response.json().get('error', {}).get('code', '')
+        except ValueError:
+            return False
+        return code.lower() in GRAPH_UNSUPPORTED_CODES
+    
+    def read_onedrive_excel_data(self, etag=None):
+        """Read data from OneDrive Excel file, reusing the last decode while etag is unchanged"""
+        if etag and self._excel_cache and self._excel_cache[0] == etag:
+            return self._excel_cache[1], None
+        
+        if not self._get_access_token():
             return None, "Failed to get access token for OneDrive"
         
         try:
-            # Get Excel file content
-            headers = {'Authorization': f'Bearer {access_token}'}
-            
-            # Download the Excel file
-            download_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{ONEDRIVE_FILE_ID}/content"
-            response = requests.get(download_url, headers=headers)
+            # Fetch only the cell values through the workbook API
+            response = self._http.get(GRAPH_VALUES_URL, timeout=GRAPH_TIMEOUT)
             
-            if response.status_code != 200:
-                return None, f"Error downloading Excel file: {response.status_code}"
+            if response.status_code == 200:
+                values = response.json().get('values', [])
+                # An empty worksheet reports a single blank cell at A1
+                if not values or values == [['']]:
+                    df = pd.DataFrame()
+                else:
+                    df = pd.DataFrame(values[1:], columns=values[0])
+                self._excel_cache = (etag, df) if etag else None
+                return df, None
             
-            # Save temporarily and read with pandas
-            temp_file = 'temp_excel.xlsx'
-            with open(temp_file, 'wb') as f:
-                f.write(response.content)
+            if not self._workbook_unsupported(response):
+                return None, f"Error reading Excel range: {response.status_code}"
             
-            df = pd.read_excel(temp_file, sheet_name=EXCEL_WORKSHEET_NAME)
-            os.remove(temp_file)  # Clean up temp file
+            # The workbook API is not available for every file, so fall back to the .xlsx
+            buf = io.BytesIO()
+            with self._http.get(GRAPH_CONTENT_URL, stream=True, timeout=GRAPH_TIMEOUT) as response:
+                if response.status_code != 200:
+                    return None, f"Error downloading Excel file: {response.status_code}"
+                
+                # Copy in chunks rather than holding response.content alongside the buffer
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    buf.write(chunk)
             
+            buf.seek(0)
+            df = pd.read_excel(buf, sheet_name=EXCEL_WORKSHEET_NAME)
+            self._excel_cache = (etag, df) if etag else None
             return df, None
         except Exception as e:
             return None, f"Error reading OneDrive Excel: {str(e)}"
     
     def write_onedrive_excel_data(self, data):
         """Write data to OneDrive Excel file"""
-        access_token = self._get_access_token()
-        if not access_token:
+        if not self._get_access_token():
             return False, "Failed to get access token for OneDrive"
         
         try:
-            # Create Excel file in memory
-            temp_file = 'temp_upload.xlsx'
-            if isinstance(data, pd.DataFrame):
-                data.to_excel(temp_file, sheet_name=EXCEL_WORKSHEET_NAME, index=False)
-            else:
-                df = pd.DataFrame(data[1:], columns=data[0])
-                df.to_excel(temp_file, sheet_name=EXCEL_WORKSHEET_NAME, index=False)
+            values = self._to_cell_values(data)
+            rows = len(values)
+            cols = len(values[0]) if values else 0
             
-            # Upload to OneDrive
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            }
+            if cols:
+                # Write before clearing so a failed update never blanks the sheet, in row
+                # blocks so large sheets stay under Graph's request size limit. The text
+                # format keeps Excel from parsing cells like "=1", "00123" or "1/2"
+                block_rows = max(1, GRAPH_MAX_CELLS_PER_PATCH // cols)
+                for start in range(0, rows, block_rows):
+                    block = values[start:start + block_rows]
+                    address = f"A{start + 1}:{get_column_letter(cols)}{start + len(block)}"
+                    response = self._http.patch(
+                        f"{GRAPH_WORKSHEET_URL}/range(address='{address}')",
+                        headers=GRAPH_JSON_HEADERS,
+                        data=json.dumps({'numberFormat': [['@'] * cols] * len(block), 'values': block},
+                                        default=str),
+                        timeout=GRAPH_TIMEOUT
+                    )
+                    
+                    if response.status_code != 200:
+                        if self._workbook_unsupported(response):
+                            return self._upload_excel_file(data)
+                        return False, f"Error updating Excel range: {response.status_code}"
+            
+            # Then clear whatever lies outside the new extent
+            stale = []
+            if cols < EXCEL_MAX_COLS:
+                stale.append(f"{get_column_letter(cols + 1)}:{get_column_letter(EXCEL_MAX_COLS)}")
+            if cols and rows < EXCEL_MAX_ROWS:
+                stale.append(f"{rows + 1}:{EXCEL_MAX_ROWS}")
+            
+            for address in stale:
+                response = self._http.post(
+                    f"{GRAPH_WORKSHEET_URL}/range(address='{address}')/clear",
+                    headers=GRAPH_JSON_HEADERS,
+                    data=json.dumps({'applyTo': 'Contents'}),
+                    timeout=GRAPH_TIMEOUT
+                )
+                
+                if response.status_code not in [200, 204]:
+                    if not cols and self._workbook_unsupported(response):
+                        return self._upload_excel_file(data)
+                    return False, f"Error clearing stale Excel cells: {response.status_code}"
+            
+            return True, f"Updated {rows * cols} cells"
+        except Exception as e:
+            return False, f"Error writing to OneDrive Excel: {str(e)}"
+    
+    def _upload_excel_file(self, data):
+        """Replace the OneDrive file with a fresh .xlsx for files the workbook API can't edit"""
+        try:
+            # Stream rows into a write-only workbook instead of building the full DOM
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet(EXCEL_WORKSHEET_NAME)
             
-            upload_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{ONEDRIVE_FILE_ID}/content"
+            def literal(value):
+                # openpyxl stores any string starting with "=" as a formula, so pin text cells
+                # to the string type like the workbook path's "@" format does
+                if isinstance(value, str) and value.startswith('='):
+                    cell = WriteOnlyCell(ws, value)
+                    cell.data_type = 's'
+                    return cell
+                return value
             
-            with open(temp_file, 'rb') as f:
-                response = requests.put(upload_url, headers=headers, data=f.read())
+            if isinstance(data, pd.DataFrame):
+                ws.append([literal(str(col)) for col in data.columns])
+                # Blank out missing cells row by row so no full copy of the frame is made
+                for row in data.itertuples(index=False, name=None):
+                    ws.append([None if pd.isna(cell) else literal(cell) for cell in row])
+            else:
+                for row in data:
+                    ws.append([literal(cell) for cell in row])
             
-            os.remove(temp_file)  # Clean up temp file
+            buf = io.BytesIO()
+            wb.save(buf)
+            buf.seek(0)
+            
+            # Upload to OneDrive
+            response = self._http.put(GRAPH_CONTENT_URL, headers=GRAPH_XLSX_HEADERS, data=buf,
+                                      timeout=GRAPH_TIMEOUT)
             
             if response.status_code in [200, 201]:
                 return True, "Excel file updated successfully"
@@ -223,33 +552,98 @@ class DataSyncManager:
         except Exception as e:
             return False, f"Error writing to OneDrive Excel: {str(e)}"
     
-    def _calculate_data_hash(self, data):
-        """Calculate hash of data for comparison"""
-        if isinstance(data, pd.DataFrame):
-            data_str = data.to_string()
-        else:
-            data_str = str(data)
-        return hashlib.md5(data_str.encode()).hexdigest()
+    def _calculate_data_hash(self, lines):
+        """Calculate hash of lines of cell text for comparison"""
+        h = hashlib.blake2b(digest_size=16)
+        # Feed one line at a time rather than rendering the whole table first
+        for line in lines:
+            h.update("\x1f".join(line).encode())
+            h.update(b"\x1e")
+        return h.hexdigest()
+    
+    def _canonical_hash(self, values):
+        """Hash cell values with columns sorted and every cell as text"""
+        columns = sorted(
+            (tuple('' if cell is None else str(cell) for cell in column) for column in zip(*values)),
+            key=lambda column: column[0]
+        )
+        return self._calculate_data_hash(columns)
+    
+    def _data_equal(self, a, b):
+        """Check whether two lists of cell values hold the same cells"""
+        # Different shapes or headers settle it without walking the rows; otherwise
+        # list equality stops at the first differing row
+        if len(a) != len(b) or (a and a[0] != b[0]):
+            return False
+        return a == b
+    
+    def _run_writes(self, writes):
+        """Run planned writes concurrently and report them as one sync result"""
+        futures = [(self._executor.submit(writer, data), action, failure)
+                   for writer, data, action, failure in writes]
+        
+        sync_actions = []
+        errors = []
+        for future, action, failure in futures:
+            success, message = future.result()
+            if success:
+                sync_actions.append(action)
+            else:
+                errors.append(f"{failure}: {message}")
+        
+        if errors:
+            return False, errors[0]
+        return True, f"Sync completed: {', '.join(sync_actions)}"
     
     def sync_data(self):
         """Perform two-way sync between Google Sheets and OneDrive Excel"""
+        # Overlapping requests wait for the running sync instead of interleaving with it
+        with self._sync_lock:
+            return self._sync_data()
+    
+    def _sync_data(self):
+        """Run one sync; callers must hold the sync lock"""
+        # Only this sync's read may provide the extent for its Google write
+        self._google_extent = None
+        
         try:
-            # Read data from both sources
-            google_data, google_error = self.read_google_sheets_data()
+            # Compare change tokens before downloading any content
+            google_etag_future = self._executor.submit(self._google_etag)
+            excel_etag_future = self._executor.submit(self._onedrive_etag)
+            etags = (google_etag_future.result(), excel_etag_future.result())
+            
+            if None not in etags and etags == self._last_etags:
+                return True, "No differences found - sync skipped"
+            
+            # Read data from both sources concurrently
+            google_future = self._executor.submit(self.read_google_sheets_data)
+            excel_future = self._executor.submit(self.read_onedrive_excel_data, etags[1])
+            google_data, google_error = google_future.result()
+            excel_data, excel_error = excel_future.result()
+            
             if google_error:
                 return False, f"Google Sheets error: {google_error}"
             
-            excel_data, excel_error = self.read_onedrive_excel_data()
             if excel_error:
                 return False, f"OneDrive Excel error: {excel_error}"
             
-            # Calculate hashes to check for differences
-            google_hash = self._calculate_data_hash(google_data)
-            excel_hash = self._calculate_data_hash(excel_data)
+            # Convert each side once; the comparisons and the write all reuse it
+            google_values = self._to_cell_values(google_data)
+            excel_values = self._to_cell_values(excel_data)
             
-            if google_hash == excel_hash:
+            if self._data_equal(google_values, excel_values):
+                # Remember the in-sync state so unchanged files skip the download
+                self._last_etags = etags
                 return True, "No differences found - sync skipped"
             
+            # Column order and cell types alone don't justify rewriting the target
+            if self._canonical_hash(google_values) == self._canonical_hash(excel_values):
+                self._last_etags = etags
+                return True, "No semantic differences found - sync skipped"
+            
+            # A write changes the target's tag; the next sync re-reads and records it
+            self._last_etags = None
+            
             # For simplicity, we'll use a timestamp-based approach
             # In a real application, you might want more sophisticated conflict resolution
             
@@ -261,30 +655,36 @@ class DataSyncManager:
             # This is a simplified approach - in practice, you'd want row-level timestamps
             google_modified = True  # Assume Google Sheets was modified more recently
             
-            sync_actions = []
+            # Each planned write is (writer, data, action, failure prefix); a merge
+            # that updates both stores just plans two writes and they run together
+            writes = []
             
             if google_modified:
                 # Sync Google Sheets -> Excel
-                success, message = self.write_onedrive_excel_data(google_data)
-                if success:
-                    sync_actions.append("Google Sheets → OneDrive Excel")
-                else:
-                    return False, f"Failed to sync to Excel: {message}"
+                writes.append((self.write_onedrive_excel_data, google_values,
+                               "Google Sheets → OneDrive Excel", "Failed to sync to Excel"))
             else:
                 # Sync Excel -> Google Sheets
-                success, message = self.write_google_sheets_data(excel_data)
-                if success:
-                    sync_actions.append("OneDrive Excel → Google Sheets")
-                else:
-                    return False, f"Failed to sync to Google Sheets: {message}"
+                writes.append((self.write_google_sheets_data, excel_values,
+                               "OneDrive Excel → Google Sheets", "Failed to sync to Google Sheets"))
             
-            return True, f"Sync completed: {', '.join(sync_actions)}"
+            return self._run_writes(writes)
             
         except Exception as e:
             return False, f"Sync error: {str(e)}"
 
-# Initialize sync manager
-sync_manager = DataSyncManager()
+# The sync manager is created on first use, once per process
+_sync_manager = None
+_sync_manager_lock = threading.Lock()
+
+def get_sync_manager():
+    """Return the process-wide DataSyncManager, creating it on first call"""
+    global _sync_manager
+    if _sync_manager is None:
+        with _sync_manager_lock:
+            if _sync_manager is None:
+                _sync_manager = DataSyncManager()
+    return _sync_manager
 
 @app.route('/')
 def index():
@@ -295,7 +695,7 @@ def index():
 def sync_data():
     """Handle sync request"""
     try:
-        success, message = sync_manager.sync_data()
+        success, message = get_sync_manager().sync_data()
         return jsonify({
             'success': success,
             'message': message,
@@ -312,6 +712,7 @@ def sync_data():
 @app.route('/status')
 def status():
     """Check service status"""
+    sync_manager = get_sync_manager()
     google_status = "OK" if sync_manager.google_service else "Not configured"
     msal_status = "OK" if sync_manager.msal_app else "Not configured"
     
@@ -322,5 +723,5 @@ def status():
     })
 
 if __name__ == '__main__':
-    # Enable CORS and iframe support for the runtime environment
-    app.run(host='0.0.0.0', port=12001, debug=True)
\ No newline at end of file
+    # Development server only; run under gunicorn in production (see README)
+    app.run(host='0.0.0.0', port=12001, debug=os.environ.get('FLASK_DEBUG') == '1')
\ No newline at end of file
@@ -15,7 +15,7 @@ def test_app():
     
     # Test if app can be imported
     try:
-        from app import app, sync_manager
+        from app import app, get_sync_manager
         print("✅ App imported successfully")
     except ImportError as e:
         print(f"❌ Failed to import app: {e}")
@@ -36,7 +36,7 @@ def test_app():
         print("⚠️  Secret key not configured (using default)")
     
     # Test sync manager initialization
-    if sync_manager:
+    if get_sync_manager():
         print("✅ Sync manager initialized")
     else:
         print("❌ Sync manager failed to initialize")
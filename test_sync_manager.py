@@ -0,0 +1,523 @@
+"""
+Offline checks for DataSyncManager's conversion, comparison and write helpers
+"""
+
+import datetime
+import decimal
+import gzip
+import io
+import json
+import logging
+import threading
+from unittest import mock
+
+import httplib2
+import openpyxl
+import pandas as pd
+import pytest
+
+import app
+from app import DataSyncManager, GzipHttp, _a1_range_limits, _log_level
+
+
+@pytest.fixture
+def manager():
+    """A sync manager with no Google or MSAL clients and a fake Graph session"""
+    with mock.patch.object(DataSyncManager, '_init_google_service'), \
+            mock.patch.object(DataSyncManager, '_init_msal_app'):
+        sync_manager = DataSyncManager()
+    sync_manager._http = mock.MagicMock()
+    sync_manager._get_access_token = lambda: 'token'
+    return sync_manager
+
+
+def graph_response(status_code, error_code=None):
+    """Fake Graph response with an optional error code in the body"""
+    response = mock.MagicMock(status_code=status_code)
+    response.json.return_value = {'error': {'code': error_code}} if error_code else {}
+    return response
+
+
+# Comparison
+
+def test_canonical_hash_ignores_cell_types_and_column_order(manager):
+    google_rows = manager._to_cell_values([['name', 'qty'], ['apple', '3'], ['pear']])
+    excel_frame = pd.DataFrame({'qty': [3, float('nan')], 'name': ['apple', 'pear']})
+    excel_frame['qty'] = excel_frame['qty'].astype('Int64')
+
+    assert manager._canonical_hash(google_rows) == manager._canonical_hash(manager._to_cell_values(excel_frame))
+
+
+def test_canonical_hash_detects_changed_cells(manager):
+    google_rows = [['name', 'qty'], ['apple', '3']]
+    excel_frame = pd.DataFrame({'name': ['apple'], 'qty': [4]})
+
+    assert manager._canonical_hash(google_rows) != manager._canonical_hash(manager._to_cell_values(excel_frame))
+
+
+def test_data_equal_matches_text_workbook_with_ragged_google_rows(manager):
+    google_rows = manager._to_cell_values([['name', 'qty'], ['apple', '3'], ['pear']])
+    excel_frame = pd.DataFrame({'name': ['apple', 'pear'], 'qty': ['3', '']})
+
+    assert manager._data_equal(google_rows, manager._to_cell_values(excel_frame))
+    assert not manager._data_equal(google_rows, manager._to_cell_values(excel_frame.assign(qty=['4', ''])))
+    assert not manager._data_equal(google_rows, manager._to_cell_values(excel_frame.rename(columns={'qty': 'n'})))
+
+
+def test_to_cell_values_returns_rectangular_rows_as_is(manager):
+    rows = [['a', 'b'], ['1', '2']]
+
+    assert manager._to_cell_values(rows) is rows
+
+
+# Cell conversion
+
+def test_to_cell_values_blanks_missing_and_stays_json_serializable(manager):
+    frame = pd.DataFrame({
+        'float': [1.5, float('nan')],
+        'int': pd.array([1, None], dtype='Int64'),
+        'flag': pd.array([True, None], dtype='boolean'),
+        'text': ['x', None],
+        'when': pd.to_datetime(['2024-01-02 03:04:05', None]),
+    })
+
+    values = manager._to_cell_values(frame)
+
+    assert values == [
+        ['float', 'int', 'flag', 'text', 'when'],
+        [1.5, 1, True, 'x', '2024-01-02 03:04:05'],
+        ['', '', '', '', ''],
+    ]
+    json.dumps(values)
+
+
+def test_to_cell_values_stringifies_objects_json_cannot_carry(manager):
+    frame = pd.DataFrame({
+        'mixed': pd.Series([datetime.date(2024, 1, 2), decimal.Decimal('1.50')], dtype=object),
+        'when': pd.Series([datetime.datetime(2024, 1, 2, 3, 4, 5), 'n/a'], dtype=object),
+    })
+
+    values = manager._to_cell_values(frame)
+
+    assert values == [['mixed', 'when'], ['2024-01-02', '2024-01-02 03:04:05'], ['1.50', 'n/a']]
+    json.dumps(values)
+
+
+def test_to_cell_values_pads_ragged_rows(manager):
+    assert manager._to_cell_values([['a', 'b', 'c'], ['1'], []]) == [
+        ['a', 'b', 'c'], ['1', '', ''], ['', '', '']
+    ]
+
+
+# Gzip transport
+
+def test_gzip_http_compresses_large_bodies_and_fixes_headers():
+    body = json.dumps({'values': [['cell'] * 2000]})
+    with mock.patch.object(httplib2.Http, 'request', return_value=('resp', b'')) as request:
+        GzipHttp().request('https://example.test', 'POST', body,
+                           {'Content-Length': str(len(body)), 'content-type': 'application/json'})
+
+    _, _, sent_body, sent_headers = request.call_args.args
+    assert gzip.decompress(sent_body).decode() == body
+    assert sent_headers == {
+        'content-type': 'application/json',
+        'content-encoding': 'gzip',
+        'content-length': str(len(sent_body)),
+    }
+
+
+def test_gzip_http_leaves_small_bodies_alone():
+    with mock.patch.object(httplib2.Http, 'request', return_value=('resp', b'')) as request:
+        GzipHttp().request('https://example.test', 'POST', '{}', {'content-length': '2'})
+
+    assert request.call_args.args == ('https://example.test', 'POST', '{}', {'content-length': '2'})
+
+
+def test_gzip_http_keeps_build_http_defaults():
+    http = GzipHttp()
+
+    assert http.timeout == 60
+    assert 308 not in http.redirect_codes
+
+
+# Google Sheets writes
+
+@pytest.mark.parametrize('a1_range, limits', [
+    ('Sheet1!A:Z', (None, 26)),
+    ('Sheet1!$B$2:$D$11', (10, 3)),
+    ('Sheet1!A2:C', (None, 3)),
+    ("'My Sheet'!A1:B2", (2, 2)),
+    ("'Q1'", (None, None)),
+    ('Jan', None),
+    ('Q1', None),
+])
+def test_a1_range_limits(a1_range, limits):
+    assert _a1_range_limits(a1_range) == limits
+
+
+def google_write_values(manager):
+    """Values sent by the last batchUpdate"""
+    batch_update = manager.google_service.spreadsheets().values().batchUpdate
+    return batch_update.call_args.kwargs['body']['data'][0]['values']
+
+
+def test_google_write_pads_to_previous_extent_instead_of_clearing(manager):
+    manager.google_service = mock.MagicMock()
+    manager._google_extent = (3, 3)
+
+    success, _ = manager.write_google_sheets_data([['a', 'b'], ['1']])
+
+    assert success
+    assert google_write_values(manager) == [['a', 'b', ''], ['1', '', ''], ['', '', '']]
+    manager.google_service.spreadsheets().values().clear.assert_not_called()
+
+
+def test_google_write_uses_extent_once(manager):
+    manager.google_service = mock.MagicMock()
+    manager._google_extent = (3, 3)
+    manager.write_google_sheets_data([['a']])
+
+    manager.write_google_sheets_data([['a']])
+
+    manager.google_service.spreadsheets().values().clear.assert_called_once()
+    assert google_write_values(manager) == [['a']]
+
+
+def test_google_write_padding_stays_inside_configured_range(manager, monkeypatch):
+    monkeypatch.setattr(app, 'GOOGLE_RANGE_LIMITS', (2, 2))
+    manager.google_service = mock.MagicMock()
+    manager._google_extent = (5, 30)
+
+    manager.write_google_sheets_data([['a']])
+
+    assert google_write_values(manager) == [['a', ''], ['', '']]
+
+
+def test_google_write_clears_when_range_size_is_unknown(manager, monkeypatch):
+    monkeypatch.setattr(app, 'GOOGLE_RANGE_LIMITS', None)
+    manager.google_service = mock.MagicMock()
+    manager._google_extent = (3, 3)
+
+    manager.write_google_sheets_data([['a']])
+
+    manager.google_service.spreadsheets().values().clear.assert_called_once()
+    assert google_write_values(manager) == [['a']]
+
+
+# OneDrive writes
+
+def test_excel_write_keeps_sheet_when_update_fails(manager):
+    manager._http.patch.return_value = graph_response(403)
+
+    success, message = manager.write_onedrive_excel_data([['a'], ['1']])
+
+    assert not success and '403' in message
+    manager._http.post.assert_not_called()
+    manager._http.put.assert_not_called()
+
+
+def test_excel_write_stores_text_then_trims_stale_cells(manager):
+    manager._http.patch.return_value = graph_response(200)
+    manager._http.post.return_value = graph_response(204)
+
+    success, _ = manager.write_onedrive_excel_data([['id', 'note'], ['00123', '=1+1']])
+
+    assert success
+    body = json.loads(manager._http.patch.call_args.kwargs['data'])
+    assert body['numberFormat'] == [['@', '@'], ['@', '@']]
+    assert body['values'] == [['id', 'note'], ['00123', '=1+1']]
+    cleared = [call.args[0] for call in manager._http.post.call_args_list]
+    assert cleared == [
+        f"{app.GRAPH_WORKSHEET_URL}/range(address='C:XFD')/clear",
+        f"{app.GRAPH_WORKSHEET_URL}/range(address='3:1048576')/clear",
+    ]
+
+
+def test_excel_write_splits_large_sheets_into_row_blocks(manager, monkeypatch):
+    monkeypatch.setattr(app, 'GRAPH_MAX_CELLS_PER_PATCH', 4)
+    manager._http.patch.return_value = graph_response(200)
+    manager._http.post.return_value = graph_response(204)
+
+    success, _ = manager.write_onedrive_excel_data([['a', 'b'], ['1', '2'], ['3', '4'], ['5', '6'], ['7', '8']])
+
+    assert success
+    addresses = [call.args[0] for call in manager._http.patch.call_args_list]
+    assert addresses == [
+        f"{app.GRAPH_WORKSHEET_URL}/range(address='A1:B2')",
+        f"{app.GRAPH_WORKSHEET_URL}/range(address='A3:B4')",
+        f"{app.GRAPH_WORKSHEET_URL}/range(address='A5:B5')",
+    ]
+    last_block = json.loads(manager._http.patch.call_args.kwargs['data'])
+    assert last_block == {'numberFormat': [['@', '@']], 'values': [['7', '8']]}
+
+
+def test_excel_write_does_not_fall_back_on_throttling(manager):
+    manager._http.patch.return_value = graph_response(429)
+
+    success, _ = manager.write_onedrive_excel_data([['a'], ['1']])
+
+    assert not success
+    manager._http.put.assert_not_called()
+
+
+@pytest.mark.parametrize('response', [graph_response(400, 'NotSupported'), graph_response(413)])
+def test_excel_write_falls_back_to_file_upload(manager, response):
+    manager._http.patch.return_value = response
+    manager._http.put.return_value = graph_response(200)
+
+    success, _ = manager.write_onedrive_excel_data([['a'], ['1']])
+
+    assert success
+    assert manager._http.put.call_args.args[0] == app.GRAPH_CONTENT_URL
+
+
+def test_excel_file_upload_keeps_formula_like_text_literal(manager):
+    manager._http.put.return_value = graph_response(200)
+
+    success, _ = manager._upload_excel_file([['note', 'qty'], ['=1+1', 3]])
+
+    assert success
+    workbook = openpyxl.load_workbook(manager._http.put.call_args.kwargs['data'])
+    cell = workbook[app.EXCEL_WORKSHEET_NAME]['A2']
+    assert (cell.value, cell.data_type) == ('=1+1', 's')
+    assert workbook[app.EXCEL_WORKSHEET_NAME]['B2'].value == 3
+
+
+def test_excel_read_falls_back_to_file_download_when_range_too_large(manager):
+    buf = io.BytesIO()
+    pd.DataFrame({'a': [1]}).to_excel(buf, sheet_name=app.EXCEL_WORKSHEET_NAME, index=False)
+    download = mock.MagicMock(status_code=200)
+    download.iter_content.return_value = [buf.getvalue()]
+    download.__enter__.return_value = download
+    manager._http.get.side_effect = [graph_response(413), download]
+
+    df, error = manager.read_onedrive_excel_data()
+
+    assert error is None
+    assert df.to_dict('list') == {'a': [1]}
+    assert manager._http.get.call_args.args[0] == app.GRAPH_CONTENT_URL
+
+
+# MSAL token cache
+
+def test_corrupt_token_cache_does_not_disable_msal(manager, tmp_path, monkeypatch):
+    cache_path = tmp_path / 'msal_cache.bin'
+    cache_path.write_text('{bad')
+    monkeypatch.setattr(app, 'MSAL_CACHE_PATH', str(cache_path))
+
+    with mock.patch('msal.ConfidentialClientApplication') as client_app:
+        manager._init_msal_app()
+
+    assert manager.msal_app is client_app.return_value
+    assert client_app.call_args.kwargs['token_cache'] is manager._token_cache
+
+
+# Sync serialization
+
+def test_sync_runs_under_the_sync_lock(manager):
+    manager._sync_data = lambda: (manager._sync_lock.locked(), "done")
+
+    assert manager.sync_data() == (True, "done")
+    assert not manager._sync_lock.locked()
+
+
+def test_overlapping_sync_waits_for_the_running_one(manager):
+    manager._sync_data = lambda: (True, "done")
+    manager._sync_lock.acquire()
+    waiting = threading.Thread(target=manager.sync_data)
+    waiting.start()
+
+    waiting.join(timeout=0.2)
+    assert waiting.is_alive()
+    manager._sync_lock.release()
+    waiting.join(timeout=5)
+    assert not waiting.is_alive()
+
+
+def test_graph_calls_have_a_timeout(manager):
+    manager._http.patch.return_value = graph_response(200)
+    manager._http.post.return_value = graph_response(204)
+    manager._http.get.return_value = graph_response(200)
+
+    manager._onedrive_etag()
+    manager.read_onedrive_excel_data()
+    manager.write_onedrive_excel_data([['a'], ['1']])
+
+    calls = manager._http.get.call_args_list + manager._http.patch.call_args_list + manager._http.post.call_args_list
+    assert calls and all(call.kwargs['timeout'] == app.GRAPH_TIMEOUT for call in calls)
+
+
+# Logging
+
+@pytest.mark.parametrize('name, level', [
+    ('info', logging.INFO),
+    (' Debug ', logging.DEBUG),
+    ('10', 10),
+    ('loud', logging.WARNING),
+    ('', logging.WARNING),
+])
+def test_log_level_accepts_any_case_and_falls_back_to_warning(name, level):
+    assert _log_level(name) == level
+
+
+# Change tokens
+
+def stub_sources(manager, google_rows, excel_frame, etags=('g1', 'x1')):
+    """Replace the Google and OneDrive calls of a sync with fakes"""
+    manager._google_etag = mock.Mock(return_value=etags[0])
+    manager._onedrive_etag = mock.Mock(return_value=etags[1])
+    manager.read_google_sheets_data = mock.Mock(return_value=(google_rows, None))
+    manager.read_onedrive_excel_data = mock.Mock(return_value=(excel_frame, None))
+    manager.write_onedrive_excel_data = mock.Mock(return_value=(True, "Updated"))
+
+
+def test_sync_records_change_tokens_when_in_sync(manager):
+    stub_sources(manager, [['a'], ['1']], pd.DataFrame({'a': ['1']}))
+
+    success, _ = manager.sync_data()
+
+    assert success
+    assert manager._last_etags == ('g1', 'x1')
+    manager.write_onedrive_excel_data.assert_not_called()
+
+
+def test_sync_skips_reads_when_change_tokens_are_unchanged(manager):
+    stub_sources(manager, [['a'], ['1']], pd.DataFrame({'a': ['1']}))
+    manager._last_etags = ('g1', 'x1')
+
+    success, message = manager.sync_data()
+
+    assert success and 'skipped' in message
+    manager.read_google_sheets_data.assert_not_called()
+    manager.read_onedrive_excel_data.assert_not_called()
+
+
+def test_sync_rereads_when_a_change_token_is_missing(manager):
+    stub_sources(manager, [['a'], ['1']], pd.DataFrame({'a': ['1']}), etags=('g1', None))
+    manager._last_etags = ('g1', None)
+
+    manager.sync_data()
+
+    manager.read_google_sheets_data.assert_called_once()
+
+
+def test_sync_forgets_change_tokens_after_a_write(manager):
+    stub_sources(manager, [['a'], ['2']], pd.DataFrame({'a': ['1']}))
+    manager._last_etags = ('g0', 'x0')
+
+    success, _ = manager.sync_data()
+
+    assert success
+    manager.write_onedrive_excel_data.assert_called_once_with([['a'], ['2']])
+    assert manager._last_etags is None
+
+
+# Excel read cache
+
+def values_response(values):
+    """Fake usedRange response holding the given values"""
+    response = graph_response(200)
+    response.json.return_value = {'values': values}
+    return response
+
+
+def test_excel_read_reuses_decode_while_ctag_is_unchanged(manager):
+    manager._http.get.return_value = values_response([['a'], ['1']])
+    first, _ = manager.read_onedrive_excel_data('ctag-1')
+
+    second, error = manager.read_onedrive_excel_data('ctag-1')
+
+    assert error is None and second is first
+    manager._http.get.assert_called_once()
+
+
+def test_excel_read_refetches_when_ctag_changes(manager):
+    manager._http.get.side_effect = [values_response([['a'], ['1']]), values_response([['a'], ['2']])]
+    manager.read_onedrive_excel_data('ctag-1')
+
+    df, _ = manager.read_onedrive_excel_data('ctag-2')
+
+    assert df.to_dict('list') == {'a': ['2']}
+    assert manager._excel_cache[0] == 'ctag-2'
+
+
+def test_excel_read_without_ctag_is_not_cached(manager):
+    manager._http.get.return_value = values_response([['a'], ['1']])
+
+    manager.read_onedrive_excel_data()
+    manager.read_onedrive_excel_data()
+
+    assert manager._http.get.call_count == 2
+    assert manager._excel_cache is None
+
+
+# Graph tokens
+
+@pytest.fixture
+def token_manager(manager):
+    """A sync manager using the real token logic against a fake MSAL app"""
+    del manager._get_access_token
+    manager._save_token_cache = mock.Mock()
+    manager.msal_app = mock.Mock()
+    manager.msal_app.acquire_token_for_client.side_effect = [
+        {'access_token': 'first', 'expires_in': 3600},
+        {'access_token': 'second', 'expires_in': 3600},
+    ]
+    return manager
+
+
+def test_access_token_is_reused_until_shortly_before_expiry(token_manager):
+    with mock.patch.object(app.time, 'monotonic', return_value=1000):
+        assert token_manager._get_access_token() == 'first'
+    with mock.patch.object(app.time, 'monotonic', return_value=1000 + 3600 - 61):
+        assert token_manager._get_access_token() == 'first'
+
+    token_manager.msal_app.acquire_token_for_client.assert_called_once()
+
+
+def test_access_token_is_refreshed_near_expiry(token_manager):
+    with mock.patch.object(app.time, 'monotonic', return_value=1000):
+        token_manager._get_access_token()
+    with mock.patch.object(app.time, 'monotonic', return_value=1000 + 3600 - 30):
+        assert token_manager._get_access_token() == 'second'
+
+    assert token_manager.msal_app.acquire_token_for_client.call_count == 2
+
+
+def test_refreshed_token_is_bound_to_the_graph_session(token_manager):
+    token_manager._http.headers = {}
+
+    with mock.patch.object(app.time, 'monotonic', return_value=1000):
+        token_manager._get_access_token()
+    assert token_manager._http.headers['Authorization'] == 'Bearer first'
+
+    with mock.patch.object(app.time, 'monotonic', return_value=1000 + 3600):
+        token_manager._get_access_token()
+    assert token_manager._http.headers['Authorization'] == 'Bearer second'
+
+
+# Planned writes
+
+def test_run_writes_reports_every_completed_action(manager):
+    writes = [
+        (mock.Mock(return_value=(True, "ok")), [['a']], "Google Sheets → OneDrive Excel", "Failed to sync to Excel"),
+        (mock.Mock(return_value=(True, "ok")), [['a']], "OneDrive Excel → Google Sheets", "Failed to sync to Google Sheets"),
+    ]
+
+    assert manager._run_writes(writes) == (
+        True, "Sync completed: Google Sheets → OneDrive Excel, OneDrive Excel → Google Sheets"
+    )
+    for writer, data, _, _ in writes:
+        writer.assert_called_once_with(data)
+
+
+def test_run_writes_reports_the_first_failure_after_running_all(manager):
+    last_writer = mock.Mock(return_value=(False, "quota"))
+    writes = [
+        (mock.Mock(return_value=(True, "ok")), [['a']], "to Excel", "Failed to sync to Excel"),
+        (mock.Mock(return_value=(False, "HTTP 500")), [['a']], "to Google", "Failed to sync to Google Sheets"),
+        (last_writer, [['a']], "to Google again", "Failed again"),
+    ]
+
+    assert manager._run_writes(writes) == (False, "Failed to sync to Google Sheets: HTTP 500")
+    last_writer.assert_called_once()